@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 # bots_simulator.py
 # Simulateur de bots pour ton chat LAN (connecte N bots, actions aléatoires)
+# Tous les bots tournent en coroutines asyncio sur un seul thread.
 # Usage: python3 bots_simulator.py --host 192.168.1.15 --port 2323 --bots 20 --rate 3
 
-import socket
-import threading
+import asyncio
+import bisect
+import itertools
 import time
 import random
 import argparse
@@ -35,37 +37,45 @@ SAMPLE_ACTIONS = [
     "disconnect",   # coupe la connexion brutalement
 ]
 
+# weights of SAMPLE_ACTIONS (adjust probabilities), as a cumulative table
+# so each pick is one random() + bisect
+ACTION_WEIGHTS = [60, 10, 8, 6, 4, 4, 4, 4]
+_CUM = list(itertools.accumulate(ACTION_WEIGHTS))
+_TOT = _CUM[-1]
+
+MAX_NICK_RETRIES = 5    # new random nicks tried when the server says the name is taken
+
 # --- Fonction utilitaires bots ---
 def rand_nick():
     return f"Bot{random.randint(1000,9999)}"
 
-def safe_recv(sock, timeout=2):
-    sock.settimeout(timeout)
+async def safe_recv(reader, timeout=2):
     try:
-        data = sock.recv(4096)
+        data = await asyncio.wait_for(reader.read(4096), timeout)
         return data.decode("utf-8", errors="ignore")
-    except socket.timeout:
+    except asyncio.TimeoutError:
         return ""
     except Exception:
         return ""
 
-def send_line(sock, line):
-    try:
-        sock.sendall((line + "\r\n").encode("utf-8", errors="ignore"))
-    except Exception:
-        raise
+async def send_line(writer, line):
+    if writer.is_closing():
+        raise ConnectionError("connection closed")
+    writer.write((line + "\r\n").encode("utf-8", errors="ignore"))
+    await writer.drain()
 
-# --- Classe BotThread ---
-class BotThread(threading.Thread):
+# --- Classe Bot ---
+class Bot:
     def __init__(self, id_num, host, port, rate, verbose=False, simulate_unstable=False):
-        super().__init__(daemon=True)
         self.id_num = id_num
         self.host = host
         self.port = port
         self.rate = rate        # moyenne d'intervalle entre actions (en secondes)
         self.verbose = verbose
         self.simulate_unstable = simulate_unstable
-        self.sock = None
+        self.reader = None
+        self.writer = None
+        self.task = None        # asyncio task running self.run()
         self.name = rand_nick()
         self.alive = True
 
@@ -73,89 +83,96 @@ class BotThread(threading.Thread):
         if self.verbose:
             print(f"[{self.name}]", *args)
 
-    def connect(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5)
-        s.connect((self.host, self.port))
-        self.sock = s
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), 5
+        )
         # read welcome prompt (may contain "Choose a nickname:")
-        pre = safe_recv(self.sock, timeout=1)
+        pre = await safe_recv(self.reader, timeout=1)
         if self.verbose:
             self.log("recv:", pre.strip())
         # send nick (no Telnet negotiations assumed - use Raw mode)
-        send_line(self.sock, self.name)
-        # read welcome message
-        safe_recv(self.sock, timeout=1)
+        await send_line(self.writer, self.name)
+        # read welcome message; with many bots the random nick may collide,
+        # pick another one on the same connection instead of starting over
+        reply = await safe_recv(self.reader, timeout=1)
+        for _ in range(MAX_NICK_RETRIES):
+            if "Name already taken" not in reply:
+                break
+            self.log("nick taken, retrying")
+            self.name = rand_nick()
+            await send_line(self.writer, self.name)
+            reply = await safe_recv(self.reader, timeout=1)
 
-    def disconnect_clean(self):
+    def close(self):
         try:
-            send_line(self.sock, "/quit")
+            if self.writer:
+                self.writer.close()
         except Exception:
             pass
+
+    async def disconnect_clean(self):
         try:
-            self.sock.close()
+            await send_line(self.writer, "/quit")
         except Exception:
             pass
-        self.sock = None
+        self.close()
+        self.writer = None
         self.alive = False
         self.log("disconnected cleanly")
 
     def disconnect_dirty(self):
         try:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+            # drop the connection without flushing or saying goodbye
+            self.writer.transport.abort()
         except Exception:
             pass
-        self.sock = None
+        self.writer = None
         self.alive = False
         self.log("disconnected dirty (abrupt)")
 
-    def do_random_action(self):
-        action = random.choices(
-            SAMPLE_ACTIONS,
-            weights=[60, 10, 8, 6, 4, 4, 4, 4],  # adjust probabilities
-            k=1
-        )[0]
+    async def do_random_action(self):
+        action = SAMPLE_ACTIONS[bisect.bisect(_CUM, random.random() * _TOT)]
 
         if action == "message":
             msg = random.choice(SAMPLE_MESSAGES)
-            send_line(self.sock, msg)
+            await send_line(self.writer, msg)
             self.log("sent message:", msg)
 
         elif action == "pm":
             # pick a random target (simple: try BotXXXX or 'User' sample)
             target = f"Bot{random.randint(1000,9999)}"
             text = "[PM] " + random.choice(SAMPLE_MESSAGES)
-            send_line(self.sock, f"/msg {target} {text}")
+            await send_line(self.writer, f"/msg {target} {text}")
             self.log("sent pm to", target)
 
         elif action == "me":
             text = "does a random action"
-            send_line(self.sock, f"/me {text}")
+            await send_line(self.writer, f"/me {text}")
             self.log("did /me")
 
         elif action == "dnd_toggle":
             # toggle on/off randomly
             mode = random.choice(["on", "off"])
-            send_line(self.sock, f"/dnd {mode}")
+            await send_line(self.writer, f"/dnd {mode}")
             self.log("set dnd", mode)
 
         elif action == "history":
-            send_line(self.sock, "/history")
+            await send_line(self.writer, "/history")
             # server will ask how many
-            time.sleep(0.2)
+            await asyncio.sleep(0.2)
             amount = random.choice(["10", "30", str(random.randint(5,50))])
-            send_line(self.sock, amount)
+            await send_line(self.writer, amount)
             # read some response
-            safe_recv(self.sock, timeout=0.5)
+            await safe_recv(self.reader, timeout=0.5)
             self.log("requested history", amount)
 
         elif action == "clear":
-            send_line(self.sock, "/clear")
+            await send_line(self.writer, "/clear")
             self.log("sent /clear")
 
         elif action == "quit_random":
-            send_line(self.sock, "/quit")
+            await send_line(self.writer, "/quit")
             self.log("quit by command")
             self.alive = False
 
@@ -164,59 +181,87 @@ class BotThread(threading.Thread):
             if random.random() < 0.5:
                 self.disconnect_dirty()
             else:
-                self.disconnect_clean()
+                await self.disconnect_clean()
 
-    def run(self):
+    async def run(self):
         try:
-            self.connect()
+            await self.connect()
         except Exception as e:
             self.log("connect failed:", e)
+            self.close()
             return
 
-        # main loop: perform actions until alive False
-        while self.alive:
-            try:
+        try:
+            # main loop: perform actions until alive False
+            while self.alive:
                 # sometimes read server messages to keep socket active
-                _ = safe_recv(self.sock, timeout=0.1)
-            except Exception:
-                pass
+                await safe_recv(self.reader, timeout=0.1)
 
-            wait = random.expovariate(1.0 / max(0.1, self.rate))
-            time.sleep(wait)
+                wait = random.expovariate(1.0 / max(0.1, self.rate))
+                await asyncio.sleep(wait)
 
-            # small chance to simulate unstable network
-            if self.simulate_unstable and random.random() < 0.02:
-                self.disconnect_dirty()
-                break
+                # small chance to simulate unstable network
+                if self.simulate_unstable and random.random() < 0.02:
+                    self.disconnect_dirty()
+                    break
 
-            try:
-                self.do_random_action()
-            except Exception as e:
-                self.log("action failed:", e)
-                # on failure, try to close and exit
                 try:
-                    self.sock.close()
-                except:
-                    pass
-                break
+                    await self.do_random_action()
+                except Exception as e:
+                    self.log("action failed:", e)
+                    # on failure, close and exit
+                    break
+        finally:
+            # ensure socket closed (also when the orchestrator cancels us)
+            self.close()
+            self.log("bot exiting")
 
-        # ensure socket closed
+# --- Orchestrateur pour N bots ---
+async def spawn_bots(host, port, bots, rate, verbose=False, unstable=False, stagger=0.05):
+    fleet = []
+    for i in range(bots):
+        b = Bot(i, host, port, rate, verbose=verbose, simulate_unstable=unstable)
+        b.task = asyncio.create_task(b.run())
+        fleet.append(b)
+        await asyncio.sleep(stagger)  # small stagger to avoid connection storm
+    return fleet
+
+async def quit_all(fleet):
+    for b in fleet:
         try:
-            if self.sock:
-                self.sock.close()
-        except:
+            if b.writer:
+                await send_line(b.writer, "/quit")
+        except Exception:
             pass
-        self.log("thread exiting")
 
-# --- Orchestrateur pour N bots ---
-def spawn_bots(host, port, bots, rate, verbose=False, unstable=False, stagger=0.05):
-    threads = []
-    for i in range(bots):
-        t = BotThread(i, host, port, rate, verbose=verbose, simulate_unstable=unstable)
-        t.start()
-        threads.append(t)
-        time.sleep(stagger)  # small stagger to avoid connection storm
-    return threads
+async def run_bots(args):
+    print(f"Spawning {args.bots} bots -> {args.host}:{args.port} (rate ~{args.rate}s).")
+    fleet = await spawn_bots(args.host, args.port, args.bots, args.rate, verbose=args.verbose, unstable=args.unstable)
+
+    start = time.time()
+    try:
+        while True:
+            alive = [b for b in fleet if not b.task.done()]
+            print(f"[ORCH] Alive bots: {len(alive)}/{len(fleet)}", end="\r")
+            await asyncio.sleep(1)
+            if args.duration > 0 and (time.time() - start) > args.duration:
+                print("\n[ORCH] Duration reached, asking bots to quit gracefully...")
+                await quit_all(fleet)
+                break
+            # if all died, stop
+            if not alive:
+                break
+    except asyncio.CancelledError:
+        # asyncio.run cancels the main task on Ctrl+C
+        print("\n[ORCH] Interrupted, attempting to stop bots...")
+        await quit_all(fleet)
+
+    # wait small time for bots to finish, then stop the stragglers
+    await asyncio.sleep(2)
+    for b in fleet:
+        b.task.cancel()
+    await asyncio.gather(*(b.task for b in fleet), return_exceptions=True)
+    print("\n[ORCH] Done.")
 
 # --- CLI et run ---
 def main():
@@ -230,39 +275,11 @@ def main():
     parser.add_argument("--unstable", action="store_true", help="Simulate occasional abrupt disconnects")
     args = parser.parse_args()
 
-    print(f"Spawning {args.bots} bots -> {args.host}:{args.port} (rate ~{args.rate}s).")
-    threads = spawn_bots(args.host, args.port, args.bots, args.rate, verbose=args.verbose, unstable=args.unstable)
-
-    start = time.time()
     try:
-        while True:
-            alive = [t for t in threads if t.is_alive()]
-            print(f"[ORCH] Alive bots: {len(alive)}/{len(threads)}", end="\r")
-            time.sleep(1)
-            if args.duration > 0 and (time.time() - start) > args.duration:
-                print("\n[ORCH] Duration reached, asking bots to quit gracefully...")
-                for t in threads:
-                    try:
-                        if t.sock:
-                            send_line(t.sock, "/quit")
-                    except Exception:
-                        pass
-                break
-            # if all died, stop
-            if not alive:
-                break
+        asyncio.run(run_bots(args))
     except KeyboardInterrupt:
-        print("\n[ORCH] Interrupted, attempting to stop bots...")
-        for t in threads:
-            try:
-                if t.sock:
-                    send_line(t.sock, "/quit")
-            except:
-                pass
-
-    # wait small time for threads to finish
-    time.sleep(2)
-    print("\n[ORCH] Done.")
+        # run_bots already cleaned up after the cancellation
+        pass
 
 if __name__ == "__main__":
     main()
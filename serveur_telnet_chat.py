@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 # chat_server.py
 # Version robuste : gestion propre des deconnexions inattendues + features (mentions, history, dnd, etc.)
+# Boucle asyncio unique : une coroutine par client au lieu d'un thread OS par client.
 
+import asyncio
+import collections
 import socket
-import threading
-import datetime
+import time
 import random
 import os
+import re
 import sys
 import traceback
 import urllib.request
 import json
 
+try:
+    # optional: libuv-based event loop, drop-in faster than the default selector loop
+    import uvloop
+except ImportError:
+    uvloop = None
+
 HOST = "0.0.0.0"
 PORT = 2323
+LISTEN_BACKLOG = 512     # pending connections (capped by net.core.somaxconn), room for a bot storm
 LOG_FILE = "chat_log.txt"
+LOG_FLUSH_INTERVAL = 2   # seconds between flushes of the buffered log file
+HISTORY_SIZE = 2000      # log lines kept in memory for /history
+# bytes a client may leave unread in its transport buffer before it is dropped
+MAX_SEND_BUFFER = 256 * 1024
+TRACEBACK_INTERVAL = 60  # seconds between full tracebacks for the same kind of error
+GEOIP_TIMEOUT = 5   # seconds for the ipapi.co lookup
+GEOIP_CACHE_SIZE = 4096   # completed lookups kept (ip -> country)
+GEOIP_MAX_PENDING = 32    # clients allowed to wait on an uncached lookup at once
+LINE_LIMIT = 2048   # max bytes per line read from a client (old recv(2048) size)
+NICK_MAX_LEN = 32
 
 # ANSI colors (safe for PuTTY raw mode)
 COLORS = [
@@ -31,122 +51,375 @@ ALERT_COLOR = "\033[91m"  # red for mentions/alerts
 SERVER_ALERT = "\033[94m" # blue for server notifications
 HISTORY_COLOR = "\033[94m"
 
-clients = {}   # socket -> {addr,name,color,dnd}
-lock = threading.Lock()
+# pre-encoded pieces for lines assembled as bytes (see chat_line)
+RESET_B = RESET.encode()
+
+# nicknames: letters, digits, "_", with "." or "-" inside (Jean-Luc, a.b), no spaces;
+# mentions use the same grammar so every nickname can be @mentioned
+NICK_PATTERN = r'\w(?:[\w.-]*\w)?'
+_NICK_RE = re.compile(NICK_PATTERN)
+_MENTION_RE = re.compile(r'@(' + NICK_PATTERN + r')')
+_NICK_SEP_RE = re.compile(r'[.-]')
+
+# built once at import, sent as-is on every /help
+HELP_TEXT_BYTES = (
+    f"\r\n{GREEN_HACKER}Available commands:{RESET}\r\n"
+    f"{CMD_COLOR}/help{RESET}    - Show this help message\r\n"
+    f"{CMD_COLOR}/users{RESET}   - List connected users\r\n"
+    f"{CMD_COLOR}/quit{RESET}    - Leave the chat\r\n"
+    f"{CMD_COLOR}/msg {SYS_COLOR}<user> <text>{RESET} - Send private message\r\n"
+    f"{CMD_COLOR}/me {SYS_COLOR}<text>{RESET} - Say something in third person\r\n"
+    f"{CMD_COLOR}/clear{RESET}   - Clear your screen\r\n"
+    f"{CMD_COLOR}/history{RESET} - Reload old messages from logs\r\n"
+    f"{CMD_COLOR}/dnd {SYS_COLOR}on{RESET}|{SYS_COLOR}off{RESET} - Toggle Do Not Disturb mode\r\n"
+    "\r\n"
+).encode("utf-8")
+
+# Autoriser IP locales
+LAN_PREFIXES = ("127.", "192.168.", "10.", "172.")
+
+# writer -> {addr,name,color,dnd}
+# everything runs on the event loop thread, so no lock is needed around it
+clients = {}
+name_index = {}   # name -> writer, kept in sync with clients (join/leave)
+_users_cache = None   # encoded /users reply, None when clients changed since last build
+
+# writer -> list of encoded chunks queued during the current loop iteration;
+# flush_pending hands each client's chunks to its transport in one write
+_pending = {}
+_flush_scheduled = False
+
+LOG_FH = None   # log file kept open while the server runs (see start_server)
+# last non-empty log lines (plain text), served by /history without touching the file
+HISTORY_RING = collections.deque(maxlen=HISTORY_SIZE)
+_last_tb = {}   # (tag, exception type) -> time.monotonic() of its last full traceback
+_geo_cache = {}       # ip -> country, completed lookups only, oldest first
+_geo_inflight = {}    # ip -> task of the lookup in progress, shared by concurrent connects
+_geo_waiting = 0      # clients currently waiting on an uncached lookup
+_handler_tasks = set()   # running handle_client tasks, finished off by start_server on shutdown
 
 # -------------------- utilitaires --------------------
 
+# [second, formatted timestamp, its encoded form] - only changes once per second
+_ts_cache = [0, "", b""]
+
+def _refresh_timestamp():
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        ts = f"{TIME_COLOR}[{time.strftime('%H:%M:%S', time.localtime(now))}] {RESET}"
+        _ts_cache[:] = [now, ts, ts.encode()]
+
 def timestamp():
     """Return formatted timestamp with color (string, not ending newline)."""
-    return f"{TIME_COLOR}[{datetime.datetime.now().strftime('%H:%M:%S')}] {RESET}"
+    _refresh_timestamp()
+    return _ts_cache[1]
+
+def timestamp_bytes():
+    """Same as timestamp(), already encoded."""
+    _refresh_timestamp()
+    return _ts_cache[2]
+
+def console_log(plain, colored=None):
+    """Print message to server console and append to log file (no exception escapes).
 
-def console_log(msg):
-    """Print message to server console and append to log file (no exception escapes)."""
+    plain goes to the log file and /history; colored, if given, is what the console shows.
+    """
     try:
-        print(msg)
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            # store plain text without ANSI color codes for easier history reading
-            stripped = strip_ansi(msg)
-            f.write(stripped + "\n")
+        print(colored or plain)
+        HISTORY_RING.extend(line for line in plain.splitlines() if line.strip())
+        if LOG_FH is not None:
+            LOG_FH.write(plain + "\n")
     except Exception as e:
         print(f"[LOG ERROR] {e}", file=sys.stderr)
 
-def strip_ansi(s):
-    """Rudimentary removal of ANSI sequences for log file readability."""
-    # remove ESC [ ... m sequences
-    import re
-    return re.sub(r'\x1b\[[0-9;]*m', '', s)
+def log_exc(tag, e):
+    """Log an exception from an except block.
+
+    The full traceback is logged at most once per TRACEBACK_INTERVAL for a given
+    tag and exception type; repeats only log type and message, so clients
+    triggering the same error in a loop can't make the server format stacks nonstop.
+    """
+    now = time.monotonic()
+    key = (tag, type(e))
+    if now - _last_tb.get(key, float("-inf")) >= TRACEBACK_INTERVAL:
+        _last_tb[key] = now
+        console_log(f"{tag} {e}\n{traceback.format_exc()}")
+    else:
+        console_log(f"{tag} {type(e).__name__}: {e}")
+
+def console_alert(plain):
+    """console_log a server notification, shown in SERVER_ALERT color on the console."""
+    console_log(plain, f"{SERVER_ALERT}{plain}{RESET}")
+
+def safe_send(writer, text, raw=False):
+    """Queue text for the client; if raw True, do not append CRLF.
+
+    bytes are taken as already encoded and complete, and queued unchanged.
+    Everything queued for a client during one loop iteration is written together
+    by flush_pending, so a burst of messages leaves as one segment.
+    """
+    global _flush_scheduled
+    if writer.is_closing():
+        disconnect_client(writer)
+        return
+    if isinstance(text, bytes):
+        data = text
+    else:
+        out = text if raw else text + "\r\n"
+        data = out.encode("utf-8", errors="ignore")
+    chunks = _pending.get(writer)
+    if chunks is None:
+        _pending[writer] = [data]
+    else:
+        chunks.append(data)
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        asyncio.get_running_loop().call_soon(flush_pending)
 
-def safe_send(conn, text, raw=False):
-    """Send text safely to client; if raw True, do not append CRLF."""
+def _write_pending(writer, chunks):
     try:
-        out = text if raw else text + "\r\n"
-        conn.sendall(out.encode("utf-8", errors="ignore"))
+        writer.writelines(chunks)
     except Exception:
         # on any sending error, disconnect client cleanly
-        disconnect_client(conn)
+        disconnect_client(writer)
+        return
+    # writes never block, a client that stops reading just piles up data here;
+    # drop it before it eats the server's memory
+    if writer.transport.get_write_buffer_size() > MAX_SEND_BUFFER:
+        info = clients.get(writer)
+        name = info["name"] if info else writer.get_extra_info("peername")
+        console_log(f"{name} dropped (not reading, send buffer full).")
+        writer.transport.abort()
+        disconnect_client(writer)
+
+def flush_pending():
+    """Write out everything queued by safe_send since the last flush."""
+    global _pending, _flush_scheduled
+    _flush_scheduled = False
+    pending, _pending = _pending, {}
+    for writer, chunks in pending.items():
+        if not writer.is_closing():
+            _write_pending(writer, chunks)
 
 def broadcast(text, sender=None):
-    """Broadcast text to all clients except sender. Safe to call while clients may change."""
-    with lock:
-        for c in list(clients.keys()):
-            if c == sender:
-                continue
-            try:
-                safe_send(c, text)
-            except Exception:
-                # safe_send does disconnect_client already
-                pass
+    """Broadcast text to all clients except sender. Safe to call while clients may change.
+
+    The line is encoded once and the same bytes object is written to every client;
+    bytes (e.g. from chat_line) are taken as already encoded, CRLF included.
+    """
+    if isinstance(text, bytes):
+        buf = text
+    else:
+        buf = (text + "\r\n").encode("utf-8", errors="ignore")
+    targets = [w for w in clients if w is not sender]
+    dead = []
+    for w in targets:
+        if w.is_closing():
+            dead.append(w)
+            continue
+        safe_send(w, buf)
+    # drop dead clients only once the fan-out is done: their "left the chat"
+    # broadcast must not interleave with the line being delivered
+    for w in dead:
+        disconnect_client(w)
 
-def disconnect_client(conn):
+def disconnect_client(writer):
     """Remove client from dict and notify others; safe to call multiple times."""
-    with lock:
-        info = clients.pop(conn, None)
+    info = clients.pop(writer, None)
+    if info:
+        name_index.pop(info["name"], None)
+        invalidate_users_cache()
+    # send what is still queued (e.g. "Goodbye!") before closing
+    chunks = _pending.pop(writer, None)
+    if chunks and not writer.is_closing():
+        _write_pending(writer, chunks)
+    try:
+        writer.close()
+    except Exception:
+        pass
     if info:
         name = info.get("name", "<unknown>")
-        try:
-            conn.close()
-        except:
-            pass
         msg = f"{timestamp()}{SYS_COLOR}{name} left the chat.{RESET}"
         broadcast(msg, sender=None)
         console_log(f"{name} disconnected.")
     # else: already removed
 
+def chat_line(info, msg):
+    """Return the encoded chat line (timestamp, colored nickname, msg, CRLF) for a client."""
+    # single allocation, and immutable: the transport may keep it until it is sent
+    return b"".join((
+        timestamp_bytes(), info["color_b"], info["name_b"], RESET_B, b": ",
+        msg.encode("utf-8", errors="ignore"), b"\r\n",
+    ))
+
+def users_text():
+    """Return the encoded /users reply, rebuilt only after the user list changed."""
+    global _users_cache
+    if _users_cache is None:
+        user_list = "\r\n".join(
+            [f"- {info['color']}{info['name']}{RESET} {'(DND)' if info.get('dnd') else ''}" for info in clients.values()]
+        )
+        _users_cache = f"\r\n{SYS_COLOR}Connected users:{RESET}\r\n{user_list}\r\n".encode("utf-8", errors="ignore")
+    return _users_cache
+
+def invalidate_users_cache():
+    """Call after a join, a leave or a DND change."""
+    global _users_cache
+    _users_cache = None
+
+async def read_line(reader):
+    """Read one line from the client and return it decoded and stripped, or None on EOF."""
+    data = await reader.readline()
+    if not data:
+        return None
+    return data.decode("utf-8", errors="ignore").strip()
+
+# -------------------- geoip --------------------
+
+def geo_country(client_ip):
+    """Blocking ipapi.co lookup, returns the country code (run it off the event loop)."""
+    url = f"https://ipapi.co/{client_ip}/json/"
+    with urllib.request.urlopen(url, timeout=GEOIP_TIMEOUT) as resp:
+        data = json.load(resp)
+    return data.get("country")
+
+def _geo_done(client_ip, task):
+    _geo_inflight.pop(client_ip, None)
+    # failed lookups raise and are not cached (exception() also marks it retrieved)
+    if task.cancelled() or task.exception() is not None:
+        return
+    _geo_cache[client_ip] = task.result()
+    if len(_geo_cache) > GEOIP_CACHE_SIZE:
+        del _geo_cache[next(iter(_geo_cache))]
+
+async def geo_lookup(client_ip):
+    """Country of client_ip: cached, or one shared lookup however many clients connect from it."""
+    if client_ip in _geo_cache:
+        return _geo_cache[client_ip]
+    task = _geo_inflight.get(client_ip)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(geo_country, client_ip))
+        _geo_inflight[client_ip] = task
+        task.add_done_callback(lambda t: _geo_done(client_ip, t))
+    # shield: a client leaving must not cancel the lookup the others wait on
+    return await asyncio.shield(task)
+
+async def geo_allowed(client_ip):
+    """Return True if the client may connect (LAN or Swiss IP)."""
+    global _geo_waiting
+    if client_ip.startswith(LAN_PREFIXES):
+        return True
+    if client_ip in _geo_cache:
+        country = _geo_cache[client_ip]
+    elif _geo_waiting >= GEOIP_MAX_PENDING:
+        console_log(f"GeoIP check refused for {client_ip}: too many pending lookups")
+        return False
+    else:
+        _geo_waiting += 1
+        try:
+            country = await geo_lookup(client_ip)
+        except Exception as e:
+            console_log(f"GeoIP check failed for {client_ip}: {e}")
+            return False
+        finally:
+            _geo_waiting -= 1
+    if country != "CH":
+        console_log(f"Blocked non-Swiss IP: {client_ip} ({country})")
+        return False
+    return True
+
 # -------------------- client handler --------------------
 
-def handle_client(conn, addr):
-    # make this thread resilient; any uncaught exception must be caught here
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
+    geo_check = None
+    task = asyncio.current_task()
+    _handler_tasks.add(task)
+    # make this task resilient; any uncaught exception must be caught here
     try:
-        safe_send(conn, "Welcome to the LAN Telnet Chat!\r\nChoose a nickname: ", raw=True)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # keepalive helps detect dead peers
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # chat lines are tiny: don't let Nagle hold them back, safe_send
+            # already coalesces what is sent within one loop iteration
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # the GeoIP lookup runs while the client picks a nickname; the client stays
+        # pending (not in clients) until the lookup allows it
+        geo_check = asyncio.create_task(geo_allowed(addr[0]))
+
+        def reject_if_blocked(task):
+            # close a blocked client right away instead of waiting for its nickname;
+            # the pending read_line then sees EOF and the handler returns
+            if not task.cancelled() and task.exception() is None and not task.result():
+                writer.transport.abort()
+
+        geo_check.add_done_callback(reject_if_blocked)
+
+        safe_send(writer, "Welcome to the LAN Telnet Chat!\r\nChoose a nickname: ", raw=True)
         try:
-            data = conn.recv(1024)
+            await writer.drain()
+            nickname = await read_line(reader)
         except Exception:
-            disconnect_client(conn)
             return
-        if not data:
-            disconnect_client(conn)
+        if nickname is None:
             return
-        nickname = data.decode("utf-8", errors="ignore").strip()
         if not nickname:
             nickname = f"User{random.randint(1000,9999)}"
 
-        with lock:
-            existing = [info["name"] for info in clients.values()]
-            while nickname in existing:
-                safe_send(conn, "Name already taken. Choose another: ", raw=True)
-                try:
-                    data = conn.recv(1024)
-                except Exception:
-                    disconnect_client(conn)
-                    return
-                if not data:
-                    disconnect_client(conn)
-                    return
-                nickname = data.decode("utf-8", errors="ignore").strip()
-                if not nickname:
-                    nickname = f"User{random.randint(1000,9999)}"
-
-            color = random.choice(COLORS)
-            clients[conn] = {
-                "addr": addr,
-                "name": nickname,
-                "color": color,
-                "dnd": False
-            }
+        if not await geo_check:
+            return
+
+        # re-checked after every await: another client may have taken the name meanwhile
+        while True:
+            if len(nickname) > NICK_MAX_LEN or not _NICK_RE.fullmatch(nickname):
+                prompt = f"Invalid name (max {NICK_MAX_LEN} letters, digits, _ . - and no spaces). Choose another: "
+            elif nickname in name_index:
+                prompt = "Name already taken. Choose another: "
+            else:
+                break
+            safe_send(writer, prompt, raw=True)
+            try:
+                await writer.drain()
+                nickname = await read_line(reader)
+            except Exception:
+                return
+            if nickname is None:
+                return
+            if not nickname:
+                nickname = f"User{random.randint(1000,9999)}"
+
+        color = random.choice(COLORS)
+        clients[writer] = {
+            "addr": addr,
+            "name": nickname,
+            "color": color,
+            "dnd": False,
+            # encoded once for chat_line
+            "color_b": color.encode(),
+            "name_b": nickname.encode("utf-8", errors="ignore"),
+        }
+        name_index[nickname] = writer
+        invalidate_users_cache()
 
         welcome = f"{timestamp()}{SYS_COLOR}Welcome {color}{nickname}{RESET}{SYS_COLOR}! Type /help for commands.{RESET}"
-        safe_send(conn, welcome)
-        broadcast(f"{timestamp()}{SYS_COLOR}{nickname} joined the chat.{RESET}", sender=conn)
+        safe_send(writer, welcome)
+        broadcast(f"{timestamp()}{SYS_COLOR}{nickname} joined the chat.{RESET}", sender=writer)
         console_log(f"{nickname} connected from {addr}")
 
         # main loop
         while True:
             try:
-                data = conn.recv(2048)
+                await writer.drain()
+                data = await reader.readline()
             except (ConnectionResetError, BrokenPipeError):
                 # client disconnected uncleanly
                 break
+            except ValueError:
+                # line longer than LINE_LIMIT: the reader has dropped it, keep the client
+                safe_send(writer, f"Message too long (max {LINE_LIMIT} bytes).")
+                continue
             except Exception as e:
                 console_log(f"[RECV ERROR] {e}")
                 break
@@ -156,7 +429,9 @@ def handle_client(conn, addr):
                 break
 
             try:
-                msg = data.decode("utf-8", errors="ignore").strip()
+                # drop ESC so user text is plain: nobody can inject colors/screen
+                # control into the log, /history or other terminals
+                msg = data.decode("utf-8", errors="ignore").replace("\x1b", "").strip()
             except Exception:
                 # decoding problem: ignore this message
                 continue
@@ -167,106 +442,109 @@ def handle_client(conn, addr):
             # command or chat
             if msg.startswith("/"):
                 try:
-                    handle_command(conn, msg)
+                    await handle_command(reader, writer, msg)
                 except Exception as e:
-                    console_log(f"[CMD ERROR] {e}\n{traceback.format_exc()}")
-                    safe_send(conn, "Command processing error.")
+                    log_exc("[CMD ERROR]", e)
+                    safe_send(writer, "Command processing error.")
             else:
                 # normal message
-                with lock:
-                    info = clients.get(conn)
-                    if not info:
-                        # client disappeared while processing
-                        break
-                    nickname = info["name"]
-                    color = info["color"]
-
-                formatted = f"{timestamp()}{color}{nickname}{RESET}: {msg}"
+                info = clients.get(writer)
+                if not info:
+                    # client disappeared while processing
+                    break
+                nickname = info["name"]
+
+                formatted = chat_line(info, msg)
                 # check mentions (alerts)
                 try:
-                    check_mentions(conn, msg, formatted)
-                except Exception:
-                    console_log(f"[MENTION ERROR] {traceback.format_exc()}")
-                broadcast(formatted, sender=conn)
-                safe_send(conn, formatted)
+                    check_mentions(writer, msg, formatted)
+                except Exception as e:
+                    log_exc("[MENTION ERROR]", e)
+                # sender gets its own line back: one broadcast, one encode
+                broadcast(formatted)
                 console_log(f"{nickname}: {msg}")
 
+    except asyncio.CancelledError:
+        # server shutting down: clean up below and end normally, a cancelled
+        # handler task makes asyncio print a traceback for every client
+        pass
     except Exception as e:
-        # catch-all for the thread
-        console_log(f"[THREAD EXC] {e}\n{traceback.format_exc()}")
+        # catch-all for the task
+        log_exc("[TASK EXC]", e)
     finally:
-        disconnect_client(conn)
+        _handler_tasks.discard(task)
+        if geo_check is not None:
+            # client left before the lookup finished
+            geo_check.cancel()
+        disconnect_client(writer)
 
 # -------------------- mentions / alerts --------------------
 
+def resolve_mention(token):
+    """Return the writer of the user a @token refers to, or None.
+
+    The mention pattern is greedy across "." and "-", so "@bob.see you" yields
+    "bob.see"; if that is nobody, the longest known name ending before a "." or
+    "-" of the token wins (here "bob").
+    """
+    c = name_index.get(token)
+    if c is not None:
+        return c
+    for sep in reversed([m.start() for m in _NICK_SEP_RE.finditer(token)]):
+        c = name_index.get(token[:sep])
+        if c is not None:
+            return c
+    return None
+
 def check_mentions(sender_conn, msg, formatted):
     """Detect @mentions and alert the target user (with DND support)."""
-    with lock:
-        # copy items to avoid modification during iteration
-        items = list(clients.items())
     sender_name = clients.get(sender_conn, {}).get("name", "<unknown>")
-    for c, info in items:
-        if c == sender_conn:
+    # alert each mentioned user once, in order of appearance
+    alerted = set()
+    for token in _MENTION_RE.findall(msg):
+        c = resolve_mention(token)
+        if c is None or c is sender_conn or c in alerted:
             continue
-        target_name = info.get("name", "")
-        if f"@{target_name}" in msg:
-            if info.get("dnd"):
-                console_log(f"{SERVER_ALERT}[MENTION] {sender_name} -> {target_name} (ignored, DND active){RESET}")
-                continue
-            # build alert (BEL + colored text)
-            try:
-                alert_msg = (
-                    f"\a{ALERT_COLOR}[ALERTE]{RESET} "
-                    f"{SYS_COLOR}{sender_name} mentioned you!{RESET}\r\n"
-                    f"{formatted}"
-                )
-                safe_send(c, alert_msg)
-                console_log(f"{SERVER_ALERT}[MENTION] {sender_name} -> {target_name}{RESET}")
-            except Exception:
-                # safe_send will handle disconnect
-                pass
+        alerted.add(c)
+        info = clients.get(c)
+        if not info:
+            continue
+        target_name = info["name"]
+        if info.get("dnd"):
+            console_alert(f"[MENTION] {sender_name} -> {target_name} (ignored, DND active)")
+            continue
+        # build alert (BEL + colored text)
+        alert_msg = (
+            f"\a{ALERT_COLOR}[ALERTE]{RESET} "
+            f"{SYS_COLOR}{sender_name} mentioned you!{RESET}\r\n"
+        ).encode("utf-8", errors="ignore") + formatted
+        safe_send(c, alert_msg)
+        console_alert(f"[MENTION] {sender_name} -> {target_name}")
 
 # -------------------- commands --------------------
 
-def handle_command(conn, msg):
+async def handle_command(reader, conn, msg):
     parts = msg.split(" ", 2)
     cmd = parts[0].lower()
-    with lock:
-        user_info = clients.get(conn)
+    user_info = clients.get(conn)
     if not user_info:
         return
     name = user_info["name"]
     color = user_info["color"]
 
     if cmd == "/help":
-        help_text = (
-            f"\r\n{GREEN_HACKER}Available commands:{RESET}\r\n"
-            f"{CMD_COLOR}/help{RESET}    - Show this help message\r\n"
-            f"{CMD_COLOR}/users{RESET}   - List connected users\r\n"
-            f"{CMD_COLOR}/quit{RESET}    - Leave the chat\r\n"
-            f"{CMD_COLOR}/msg {SYS_COLOR}<user> <text>{RESET} - Send private message\r\n"
-            f"{CMD_COLOR}/me {SYS_COLOR}<text>{RESET} - Say something in third person\r\n"
-            f"{CMD_COLOR}/clear{RESET}   - Clear your screen\r\n"
-            f"{CMD_COLOR}/history{RESET} - Reload old messages from logs\r\n"
-            f"{CMD_COLOR}/dnd {SYS_COLOR}on{RESET}|{SYS_COLOR}off{RESET} - Toggle Do Not Disturb mode\r\n"
-        )
-        safe_send(conn, help_text)
+        safe_send(conn, HELP_TEXT_BYTES)
 
     elif cmd == "/users":
-        with lock:
-            user_list = "\r\n".join(
-                [f"- {info['color']}{info['name']}{RESET} {'(DND)' if info.get('dnd') else ''}" for info in clients.values()]
-            )
-        safe_send(conn, f"\r\n{SYS_COLOR}Connected users:{RESET}\r\n{user_list}")
+        safe_send(conn, users_text())
 
     elif cmd == "/msg" and len(parts) >= 3:
         target_name, text = parts[1], parts[2]
         target_conn = None
-        with lock:
-            for c, info in clients.items():
-                if info["name"].lower() == target_name.lower():
-                    target_conn = c
-                    break
+        for c, info in clients.items():
+            if info["name"].lower() == target_name.lower():
+                target_conn = c
+                break
         if target_conn:
             private_msg = f"{timestamp()}(private) {color}{name}{RESET}: {text}"
             # beep only if not DND
@@ -275,15 +553,14 @@ def handle_command(conn, msg):
             else:
                 safe_send(target_conn, private_msg)
             safe_send(conn, private_msg)
-            console_log(f"{SERVER_ALERT}[PM] {name} -> {target_name}{RESET}")
+            console_alert(f"[PM] {name} -> {target_name}")
         else:
             safe_send(conn, "User not found.")
 
     elif cmd == "/me" and len(parts) >= 2:
         action = parts[1]
         msg_out = f"{timestamp()}* {color}{name}{RESET} {action}"
-        broadcast(msg_out, sender=conn)
-        safe_send(conn, msg_out)
+        broadcast(msg_out)
         console_log(f"* {name} {action}")
 
     elif cmd == "/clear":
@@ -292,10 +569,10 @@ def handle_command(conn, msg):
     elif cmd == "/history":
         safe_send(conn, "How many messages to show? (10/30/custom): ", raw=True)
         try:
-            data = conn.recv(1024)
-            if not data:
+            await conn.drain()
+            amount_data = await read_line(reader)
+            if amount_data is None:
                 return
-            amount_data = data.decode("utf-8", errors="ignore").strip()
             if amount_data.isdigit():
                 amount = int(amount_data)
             elif amount_data == "10":
@@ -310,17 +587,18 @@ def handle_command(conn, msg):
 
     elif cmd == "/dnd" and len(parts) >= 2:
         mode = parts[1].lower()
-        with lock:
-            if mode == "on":
-                clients[conn]["dnd"] = True
-                safe_send(conn, f"{SYS_COLOR}Do Not Disturb mode enabled.{RESET}")
-                console_log(f"{SERVER_ALERT}[DND] {name} activated DND mode{RESET}")
-            elif mode == "off":
-                clients[conn]["dnd"] = False
-                safe_send(conn, f"{SYS_COLOR}Do Not Disturb mode disabled.{RESET}")
-                console_log(f"{SERVER_ALERT}[DND] {name} disabled DND mode{RESET}")
-            else:
-                safe_send(conn, "Usage: /dnd on|off")
+        if mode == "on":
+            clients[conn]["dnd"] = True
+            invalidate_users_cache()
+            safe_send(conn, f"{SYS_COLOR}Do Not Disturb mode enabled.{RESET}")
+            console_alert(f"[DND] {name} activated DND mode")
+        elif mode == "off":
+            clients[conn]["dnd"] = False
+            invalidate_users_cache()
+            safe_send(conn, f"{SYS_COLOR}Do Not Disturb mode disabled.{RESET}")
+            console_alert(f"[DND] {name} disabled DND mode")
+        else:
+            safe_send(conn, "Usage: /dnd on|off")
 
     elif cmd == "/quit":
         safe_send(conn, "Goodbye!")
@@ -332,60 +610,73 @@ def handle_command(conn, msg):
 # -------------------- history --------------------
 
 def show_history(conn, amount):
+    # get last 'amount' non-empty lines
+    last_lines = list(HISTORY_RING)[-amount:]
+    safe_send(conn, f"\r\n{HISTORY_COLOR}--- Last {len(last_lines)} messages ---{RESET}")
+    for line in last_lines:
+        # send raw line (no extra color to keep history readable)
+        safe_send(conn, line)
+    safe_send(conn, f"{HISTORY_COLOR}--- End of history ---{RESET}")
+
+def load_history():
+    """Fill HISTORY_RING from the end of an existing log file (once, at startup)."""
     if not os.path.exists(LOG_FILE):
-        safe_send(conn, "No log file found.")
         return
     try:
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        # get last 'amount' non-empty lines
-        last_lines = [l.rstrip("\n") for l in lines if l.strip()][-amount:]
-        safe_send(conn, f"\r\n{HISTORY_COLOR}--- Last {len(last_lines)} messages ---{RESET}")
-        for line in last_lines:
-            # send raw line (no extra color to keep history readable)
-            safe_send(conn, line)
-        safe_send(conn, f"{HISTORY_COLOR}--- End of history ---{RESET}")
+        with open(LOG_FILE, "r", encoding="utf-8", errors="ignore") as f:
+            HISTORY_RING.extend(l.rstrip("\n") for l in f if l.strip())
     except Exception as e:
-        safe_send(conn, f"Error loading logs: {e}")
+        print(f"[LOG ERROR] {e}", file=sys.stderr)
 
 # -------------------- server start --------------------
 
-def start_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # optionally enable keepalive (helps detect dead peers)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        server.bind((HOST, PORT))
-        server.listen(100)
-        console_log(f"{SERVER_ALERT}Server started on {HOST}:{PORT}{RESET}")
-        while True:
-            try:
-                conn, addr = server.accept()
-                client_ip = addr[0]
-                # Autoriser IP locales
-                if client_ip.startswith(("127.", "192.168.", "10.", "172.")):
-                    pass
-                else:
-                    try:
-                        with urllib.request.urlopen(f"https://ipapi.co/{client_ip}/json/") as resp:
-                            data = json.load(resp)
-                            country = data.get("country")
-                            if country != "CH":
-                                console_log(f"Blocked non-Swiss IP: {client_ip} ({country})")
-                                conn.close()
-                                continue
-                    except Exception as e:
-                        console_log(f"GeoIP check failed for {client_ip}: {e}")
-                        conn.close()
-                        continue
-                # make recv non-blocking? we keep blocking but thread cleans itself
-                t = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-                t.start()
-            except KeyboardInterrupt:
-                console_log("Server shutting down (KeyboardInterrupt).")
-                break
-            except Exception as e:
-                console_log(f"[ACCEPT ERROR] {e}\n{traceback.format_exc()}")
+async def flush_log_periodically():
+    """Flush the buffered log file every LOG_FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            LOG_FH.flush()
+        except Exception as e:
+            print(f"[LOG ERROR] {e}", file=sys.stderr)
+
+async def start_server():
+    global LOG_FH
+    load_history()
+    LOG_FH = open(LOG_FILE, "a", encoding="utf-8", buffering=8192)
+    flusher = asyncio.create_task(flush_log_periodically())
+    server = None
+    try:
+        # no SO_REUSEPORT: a second instance must fail to bind, not split the room
+        server = await asyncio.start_server(handle_client, HOST, PORT,
+                                            backlog=LISTEN_BACKLOG, limit=LINE_LIMIT)
+        loop_name = "uvloop" if uvloop is not None else "asyncio"
+        console_alert(f"Server started on {HOST}:{PORT} ({loop_name})")
+        await server.serve_forever()
+    except asyncio.CancelledError:
+        # asyncio.run cancels us on Ctrl+C; log it while the file is still open
+        console_log("Server shutting down (KeyboardInterrupt).")
+        raise
+    finally:
+        if server is not None:
+            server.close()
+        # disconnect everyone (joined or still pending) while the log file is open
+        handlers = list(_handler_tasks)
+        for t in handlers:
+            t.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        flusher.cancel()
+        LOG_FH.close()
+        LOG_FH = None
 
 if __name__ == "__main__":
-    start_server()
+    try:
+        if uvloop is not None and hasattr(uvloop, "run"):
+            uvloop.run(start_server())
+        else:
+            if uvloop is not None:
+                # uvloop < 0.18 has no uvloop.run(), install its policy instead
+                uvloop.install()
+            asyncio.run(start_server())
+    except KeyboardInterrupt:
+        # already logged by start_server
+        pass